@@ -3,15 +3,13 @@
 import baostock as bs
 import pandas as pd
 import os
-import json
 from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing.util import Finalize
+from rpscommon import CACHE_DIR, list_cache_files, rebuild_close_matrix
 
-# 初始化baostock
-bs.login()
-
-# 缓存目录
-cache_dir = "stock_cache"
-os.makedirs(cache_dir, exist_ok=True)
+os.makedirs(CACHE_DIR, exist_ok=True)
 
 def fetch_all_stock_codes():
     """获取所有A股股票代码"""
@@ -34,7 +32,7 @@ def fetch_data(bs_code, start_date, end_date):
     """使用baostock获取股票数据"""
     rs = bs.query_history_k_data_plus(
         bs_code,
-        "date,code,open,high,low,close,volume,amount,isST",
+        "date,close",
         start_date=start_date,
         end_date=end_date,
         frequency="d",
@@ -49,25 +47,18 @@ def fetch_data(bs_code, start_date, end_date):
 
 def save_cache(bs_code, df):
     """保存数据到缓存"""
-    cache_file = os.path.join(cache_dir, f"{bs_code}.json")
-    df.to_json(cache_file, orient="records", date_format="iso")
+    cache_file = os.path.join(CACHE_DIR, f"{bs_code}.parquet")
+    df.to_parquet(cache_file, compression="zstd", index=False)
 
 def load_cache(bs_code):
     """加载缓存文件"""
-    cache_file_sh = os.path.join(cache_dir, f"{bs_code}.SH.json")
-    cache_file_sz = os.path.join(cache_dir, f"{bs_code}.SZ.json")
-    cache_file = cache_file_sh if os.path.exists(cache_file_sh) else cache_file_sz if os.path.exists(cache_file_sz) else None
-
-    if cache_file and os.path.exists(cache_file):
+    cache_file = os.path.join(CACHE_DIR, f"{bs_code}.parquet")
+    if os.path.exists(cache_file):
         try:
-            with open(cache_file, "r") as f:
-                cached_data = json.load(f)
-            df = pd.DataFrame(cached_data)
-            df["trade_date"] = pd.to_datetime(df["trade_date"])
-            df.set_index("trade_date", inplace=True)
-            df = df.sort_index()
-            return df
-        except (json.JSONDecodeError, ValueError):
+            df = pd.read_parquet(cache_file)
+            df.set_index("date", inplace=True)
+            return df.sort_index()
+        except (OSError, ValueError):
             print(f"Error reading cache for {bs_code}.")
     return None
 
@@ -75,28 +66,69 @@ def fetch_and_cache_stock_data(bs_code, start_date, end_date):
     """获取并缓存股票数据"""
     df = fetch_data(bs_code, start_date, end_date)
     if not df.empty:
-        df["trade_date"] = pd.to_datetime(df["date"])
-        df.set_index("trade_date", inplace=True)
-        df = df.sort_index()
+        # 下游只用到日期和收盘价，缓存里只保留这两列；
+        # baostock 返回的都是字符串，写缓存前转换成原生的日期和浮点类型。
+        # 收盘价最终都存进 float32 矩阵，缓存直接存 float32
+        df = df[["date", "close"]].copy()
+        df["date"] = pd.to_datetime(df["date"])
+        df["close"] = pd.to_numeric(df["close"], errors="coerce").astype("float32")
+        df = df.dropna(subset=["close"]).sort_values("date")
         save_cache(bs_code, df)
 
+def init_worker():
+    """工作进程登录baostock"""
+    # baostock 的连接保存在模块级全局变量里，线程间不能共享，每个进程单独登录
+    bs.login()
+    # 进程池关闭、工作进程退出时登出
+    Finalize(None, bs.logout, exitpriority=0)
+
+def fetch_all(stock_list, start_date, end_date):
+    """并发拉取所有股票，返回拉取失败的股票代码"""
+    failed = []
+    # 请求基本都在等网络返回，多个进程并发拉取，每只股票拉完即写入缓存
+    with ProcessPoolExecutor(max_workers=16, initializer=init_worker) as executor:
+        futures = {
+            executor.submit(fetch_and_cache_stock_data, bs_code, start_date, end_date): bs_code
+            for bs_code in stock_list
+        }
+        try:
+            for idx, future in enumerate(as_completed(futures)):
+                try:
+                    future.result()
+                except BrokenProcessPool:
+                    raise
+                except Exception as e:
+                    # 单只股票失败不影响其余股票，记录下来最后统一报告
+                    failed.append(futures[future])
+                    print(f"\nError fetching {futures[future]}: {e}")
+
+                # 显示进度
+                progress = (idx + 1) / len(stock_list) * 100
+                print(f"Progress: {progress:.2f}% ({idx + 1}/{len(stock_list)})", end="\r")
+        except BaseException:
+            # 中断或进程池崩溃时取消还没开始的任务，不再等剩下的股票拉完
+            executor.shutdown(cancel_futures=True)
+            raise
+    return failed
+
 def main():
-    # 获取所有A股股票代码
-    stock_list = fetch_all_stock_codes()
+    # 初始化baostock，主进程只用来获取股票列表
+    bs.login()
+    try:
+        # 获取所有A股股票代码
+        stock_list = fetch_all_stock_codes()
+    finally:
+        # 登出baostock
+        bs.logout()
     end_date = datetime.today().strftime("%Y-%m-%d")
     start_date = (datetime.today() - timedelta(days=365 * 2)).strftime("%Y-%m-%d")
 
-    for idx, bs_code in enumerate(stock_list):
-        fetch_and_cache_stock_data(bs_code, start_date, end_date)
-
-        # 显示进度
-        progress = (idx + 1) / len(stock_list) * 100
-        print(f"Progress: {progress:.2f}% ({idx + 1}/{len(stock_list)})", end="\r")
-
+    failed = fetch_all(stock_list, start_date, end_date)
     print("\nData fetching completed.")
+    if failed:
+        print(f"Failed to fetch {len(failed)} stocks: {', '.join(failed)}")
+    # 按交易日对齐的收盘价矩阵，checkrps/rpstool/train 启动时直接内存映射
+    rebuild_close_matrix(list_cache_files())
 
 if __name__ == "__main__":
     main()
-
-# 登出baostock
-bs.logout()
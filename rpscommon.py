@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""fetchdata/checkrps/rpstool/train 共用的收盘价缓存读取和指标计算"""
+
+import os
+import sys
+import pandas as pd
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+# 缓存目录
+CACHE_DIR = "stock_cache"
+# 按交易日对齐的收盘价矩阵（.npy），各脚本启动时直接内存映射
+BUNDLE_DIR = os.path.join(CACHE_DIR, "_bundle")
+
+def list_cache_files():
+    """返回按文件名排序的 Parquet 缓存文件"""
+    if not os.path.isdir(CACHE_DIR):
+        return []
+    return sorted(
+        (entry for entry in os.scandir(CACHE_DIR) if entry.name.endswith(".parquet")),
+        key=lambda entry: entry.name,
+    )
+
+def load_cache(bs_code, cache_file):
+    try:
+        df = pd.read_parquet(cache_file, columns=["date", "close"])
+        df.set_index("date", inplace=True)
+        return df.sort_index()
+    except (OSError, ValueError):
+        print(f"Error reading cache for {bs_code}.")
+    return None
+
+def build_close_matrix(all_stocks_data):
+    if not all_stocks_data:
+        return [], np.array([], dtype="datetime64[ns]"), np.empty((0, 0), dtype=np.float32)
+    # 交易日并集只求一次，各股票收盘价按日期位置直接写入预分配的 float32 矩阵
+    dates = np.unique(np.concatenate([df.index.to_numpy() for df in all_stocks_data.values()]))
+    closes = np.full((len(dates), len(all_stocks_data)), np.nan, dtype=np.float32)
+    for idx, df in enumerate(all_stocks_data.values()):
+        closes[np.searchsorted(dates, df.index.to_numpy()), idx] = df["close"].to_numpy()
+    return list(all_stocks_data.keys()), dates, closes
+
+def load_bundle(entries):
+    # bundle 记录了生成时的缓存文件列表；文件有增删，或任一文件比 bundle 新时视为过期
+    files_file = os.path.join(BUNDLE_DIR, "files.npy")
+    closes_file = os.path.join(BUNDLE_DIR, "closes.npy")
+    if not entries or not os.path.exists(files_file) or not os.path.exists(closes_file):
+        return None
+    if np.load(files_file).tolist() != [entry.name for entry in entries]:
+        return None
+    if os.path.getmtime(closes_file) < max(entry.stat().st_mtime for entry in entries):
+        return None
+    codes = np.load(os.path.join(BUNDLE_DIR, "codes.npy")).tolist()
+    dates = np.load(os.path.join(BUNDLE_DIR, "dates.npy"))
+    return codes, dates, np.load(closes_file, mmap_mode="r")
+
+def save_bundle(files, codes, dates, closes):
+    os.makedirs(BUNDLE_DIR, exist_ok=True)
+    # closes.npy 最后写入，读取方以它的修改时间判断 bundle 是否过期
+    arrays = [("files", np.array(files)), ("codes", np.array(codes)), ("dates", dates), ("closes", closes)]
+    for name, array in arrays:
+        tmp_file = os.path.join(BUNDLE_DIR, f"{name}.tmp.npy")
+        np.save(tmp_file, array)
+        os.replace(tmp_file, os.path.join(BUNDLE_DIR, f"{name}.npy"))
+
+def rebuild_close_matrix(entries):
+    """读取全部缓存文件，重新生成收盘价矩阵并写入 bundle"""
+    # 逆序遍历使同一代码同时有 sh/sz 文件时以 sh 为准
+    cache_files = {entry.name.split(".")[1]: entry.path for entry in reversed(entries)}
+    # 读取是 IO 密集型，用线程池并发
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        loaded = dict(zip(cache_files, executor.map(load_cache, cache_files.keys(), cache_files.values())))
+    all_stocks_data = {bs_code: df for bs_code, df in loaded.items() if df is not None}
+    codes, dates, closes = build_close_matrix(all_stocks_data)
+    if not codes:
+        return codes, dates, closes
+    save_bundle([entry.name for entry in entries], codes, dates, closes)
+    return codes, dates, closes
+
+def load_close_matrix():
+    """返回股票代码、交易日和按交易日对齐的 float32 收盘价矩阵"""
+    entries = list_cache_files()
+    if not entries:
+        # 旧版的 JSON 缓存不再读取，需要重新运行 fetchdata.py 生成 Parquet 缓存
+        print(f"No Parquet cache found in {CACHE_DIR}, run fetchdata.py first.", file=sys.stderr)
+        return build_close_matrix({})
+    bundle = load_bundle(entries)
+    if bundle is not None:
+        return bundle
+    return rebuild_close_matrix(entries)
+
+def align_to_latest(close_mat):
+    """把每列的有效收盘价按原顺序压到底部，使滚动窗口只覆盖该股票自己的交易日"""
+    order = np.argsort(~np.isnan(close_mat), axis=0, kind="stable")
+    return np.take_along_axis(close_mat, order, axis=0)
+
+def sma_batch(mat, window, chunk=4096):
+    """按列计算简单移动平均，结果与 rolling(window).mean() 一致
+
+    用累加和之差代替 pandas 的滚动窗口；窗口内有 NaN 时结果为 NaN。
+    每 chunk 行重新起算累加和，避免长序列累积浮点误差。
+    """
+    out = np.full(mat.shape, np.nan)
+    valid = ~np.isnan(mat)
+    values = np.where(valid, mat, 0.0)
+    pad = np.zeros((1, mat.shape[1]))
+    for start in range(window - 1, len(mat), chunk):
+        stop = min(start + chunk, len(mat))
+        lo = start - window + 1
+        sums = np.concatenate([pad, np.cumsum(values[lo:stop], axis=0)])
+        counts = np.concatenate([pad, np.cumsum(valid[lo:stop], axis=0)])
+        window_sums = sums[window:] - sums[:-window]
+        window_counts = counts[window:] - counts[:-window]
+        out[start:stop] = np.where(window_counts == window, window_sums / window, np.nan)
+    return out
+
+def pct_rank(values):
+    # 与 Series.rank(pct=True) * 100 一致：NaN 不参与排名，并列值取平均名次
+    ranks = np.full(values.shape, np.nan)
+    valid = ~np.isnan(values)
+    valid_values = values[valid]
+    order = np.argsort(valid_values, kind="stable")
+    sorted_values = valid_values[order]
+    starts = np.flatnonzero(np.r_[True, sorted_values[1:] != sorted_values[:-1]])
+    ends = np.r_[starts[1:], len(sorted_values)]
+    valid_ranks = np.empty(len(sorted_values))
+    valid_ranks[order] = np.repeat((starts + ends + 1) / 2, ends - starts)
+    ranks[valid] = valid_ranks / len(sorted_values) * 100
+    return ranks
+
+def calculate_rps(codes, close_mat, period):
+    if len(close_mat) <= period:
+        return pd.Series(np.nan, index=codes)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        pct_changes = close_mat[-1] / close_mat[-1 - period] - 1
+    return pd.Series(pct_rank(pct_changes), index=codes)
+
+def date_bounds(close_mat, dates, cutoff, side):
+    # 在共享的交易日历上只做一次二分查找，再按每列该位置之后的有效行数
+    # 换算成底部对齐矩阵中每只股票的位置
+    cal_idx = np.searchsorted(dates, np.datetime64(cutoff), side=side)
+    return len(close_mat) - np.count_nonzero(~np.isnan(close_mat[cal_idx:]), axis=0)
@@ -1,109 +1,116 @@
 #!/usr/bin/env python3
 
+import sys
 import pandas as pd
+import numpy as np
 from datetime import datetime, timedelta
-import os
-import json
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from numba import njit, prange
 from tabulate import tabulate
+from rpscommon import align_to_latest, calculate_rps, date_bounds, load_close_matrix, sma_batch
 
-# 缓存目录
-CACHE_DIR = "stock_cache"
 # 当前年份
 CURRENT_YEAR = datetime.now().year
 YEAR_START_DATE = datetime(CURRENT_YEAR, 1, 1)
 
-def load_cache(bs_code):
-    for prefix in ['sh', 'sz']:
-        cache_file = os.path.join(CACHE_DIR, f"{prefix}.{bs_code}.json")
-        if os.path.exists(cache_file):
-            try:
-                with open(cache_file, "r") as f:
-                    cached_data = json.load(f)
-                df = pd.DataFrame(cached_data)
-                df["date"] = pd.to_datetime(df["date"])
-                df.set_index("date", inplace=True)
-                df['close'] = pd.to_numeric(df['close'], errors='coerce')
-                return df.sort_index()
-            except (json.JSONDecodeError, ValueError):
-                print(f"Error reading cache for {bs_code}.")
-    print(f"No cache file found for {bs_code}")
-    return None
+def calculate_moving_averages(stock_closes):
+    return {window: sma_batch(stock_closes, window) for window in [40, 60, 120, 250]}
 
-def calculate_moving_averages(df):
-    for window in [40, 60, 120, 250]:
-        df[f"ma{window}"] = df["close"].rolling(window=window).mean()
-    return df
+def calculate_max_gain_this_year(close_mat, dates):
+    # 今年以来的行整体做一次归约，得到每只股票今年以来的最大涨幅；
+    # 今年才上市或今年没有交易的股票记为 NaN
+    year_start = np.datetime64(YEAR_START_DATE)
+    listed_before = ~np.isnan(close_mat[:np.searchsorted(dates, year_start, side="right")]).all(axis=0)
+    year_data = close_mat[np.searchsorted(dates, year_start, side="left"):]
+    if not len(year_data):
+        return np.full(close_mat.shape[1], np.nan)
+    traded = ~np.isnan(year_data)
+    year_start_price = year_data[traded.argmax(axis=0), np.arange(year_data.shape[1])]
+    max_price_this_year = np.fmax.reduce(year_data, axis=0)
+    max_gain = np.round((max_price_this_year - year_start_price) / year_start_price * 100, 2)
+    return np.where(listed_before & traded.any(axis=0), max_gain, np.nan)
 
-def calculate_rps(all_stocks_data, period):
-    all_closes = pd.DataFrame({code: data['close'] for code, data in all_stocks_data.items()})
-    pct_changes = all_closes.pct_change(periods=period, fill_method=None)
-    ranks = pct_changes.iloc[-1].rank(pct=True)
-    rps = ranks * 100
-    for code in all_stocks_data.keys():
-        all_stocks_data[code][f"rps{period}"] = rps[code]
-    return all_stocks_data
+@njit(cache=True, nogil=True)
+def filter_criteria_nb(close, ma40, ma60, ma120, ma250, idx_30d_ago, idx_year_start, rps_sum, max_gain):
+    last = len(close) - 1
+    current_price = close[last]
 
-def calculate_max_gain_this_year(df):
-    if df.index[0] > YEAR_START_DATE:
-        return None
-    year_data = df[df.index >= YEAR_START_DATE]
-    year_start_price = year_data['close'].iloc[0]
-    max_price_this_year = year_data['close'].max()
-    return ((max_price_this_year - year_start_price) / year_start_price * 100).round(2)
-
-def filter_criteria(df):
-    latest = df.iloc[-1]
     # 最近30天(20个交易日)股价新高
-    twenty_days_ago = datetime.now() - timedelta(days=30)
-    year_high = df[(df.index >= YEAR_START_DATE) & (df.index <= twenty_days_ago)]["close"].max()
-    recent_high_condition = df[df.index > twenty_days_ago]["close"].max() >= year_high
-    # RPS120与RPS250之和大于185
-    rps_condition = (latest["rps120"] + latest["rps250"]) > 190
+    if idx_year_start >= idx_30d_ago or idx_30d_ago > last:
+        return False
+    year_high = close[idx_year_start:idx_30d_ago].max()
+    max_price = close[idx_30d_ago:].max()
+    if not max_price >= year_high:
+        return False
+    # RPS120与RPS250之和大于190
+    if not rps_sum > 190:
+        return False
     # 股价站上40日均线，且60日、120日、250日均线向上发散
-    ma_condition = (latest["close"] > latest["ma40"]) and (latest["ma60"] > latest["ma120"]) and (latest["ma60"] > latest["ma250"])
+    if not (current_price > ma40[last] and ma60[last] > ma120[last] and ma60[last] > ma250[last]):
+        return False
     # 最近30天(20个交易日)最大跌幅小于30%
-    current_price = latest["close"]
-    max_price = df[df.index > twenty_days_ago]["close"].max()
-    drawdown_condition = (max_price - current_price) / max_price <= 0.30
-    # 最近一年涨幅不超过50%
-    max_gain_this_year = calculate_max_gain_this_year(df)
-    max_gain_condition = max_gain_this_year is not None and max_gain_this_year <= 80
-
-    return all([recent_high_condition, rps_condition, ma_condition, drawdown_condition, max_gain_condition])
+    if not (max_price - current_price) / max_price <= 0.30:
+        return False
+    # 今年以来最大涨幅不超过80%
+    return max_gain <= 80
 
-def process_stock(bs_code, all_stocks_data):
-    hist_data = all_stocks_data[bs_code]
-    if len(hist_data) >= 250:
-        hist_data = calculate_moving_averages(hist_data)
-        if filter_criteria(hist_data):
-            latest = hist_data.iloc[-1]
-            return {
-                "code": bs_code,
-                "rps50": round(latest["rps50"], 2),
-                "rps120": round(latest["rps120"], 2),
-                "rps250": round(latest["rps250"], 2),
-                "max_yearly_return": calculate_max_gain_this_year(hist_data),
-            }
-    return None
+@njit(parallel=True, cache=True)
+def filter_all(close, ma40, ma60, ma120, ma250, idx_30d_ago, idx_year_start, rps_sum, max_gain):
+    n_stocks = close.shape[1]
+    selected = np.zeros(n_stocks, dtype=np.bool_)
+    for j in prange(n_stocks):
+        selected[j] = filter_criteria_nb(
+            close[:, j], ma40[:, j], ma60[:, j], ma120[:, j], ma250[:, j],
+            idx_30d_ago[j], idx_year_start[j], rps_sum[j], max_gain[j],
+        )
+    return selected
 
 def main():
-    stock_list = [f.split(".")[1] for f in os.listdir(CACHE_DIR) if f.endswith(".json")]
-    all_stocks_data = {bs_code: load_cache(bs_code) for bs_code in stock_list if load_cache(bs_code) is not None and len(load_cache(bs_code)) >= 250}
+    codes, dates, close_mat = load_close_matrix()
+    # 上市不足250个交易日的股票不参与排名和筛选；矩阵存储用 float32，计算用 float64
+    eligible = np.count_nonzero(~np.isnan(close_mat), axis=0) >= 250
+    codes = [code for code, is_eligible in zip(codes, eligible) if is_eligible]
+    close_mat = close_mat[:, eligible].astype(np.float64)
+    traded = ~np.isnan(close_mat).all(axis=1)
+    close_mat, dates = close_mat[traded], dates[traded]
+
+    rps_table = pd.DataFrame(
+        {f"rps{period}": calculate_rps(codes, close_mat, period) for period in [50, 120, 250]}
+    )
+    rps_scalars = rps_table.to_dict(orient="index")
 
-    for period in [50, 120, 250]:
-        all_stocks_data = calculate_rps(all_stocks_data, period)
+    # 所有股票的均线在同一个矩阵上批量计算
+    stock_closes = align_to_latest(close_mat)
+    ma_by_window = calculate_moving_averages(stock_closes)
+    max_gains = calculate_max_gain_this_year(close_mat, dates)
 
-    with ThreadPoolExecutor(max_workers=30) as executor:
-        futures = [executor.submit(process_stock, bs_code, all_stocks_data) for bs_code in all_stocks_data.keys()]
-        selected_stocks = [result for future in as_completed(futures) if (result := future.result()) is not None]
+    selected = filter_all(
+        stock_closes, ma_by_window[40], ma_by_window[60], ma_by_window[120], ma_by_window[250],
+        date_bounds(close_mat, dates, datetime.now() - timedelta(days=30), "right"),
+        date_bounds(close_mat, dates, YEAR_START_DATE, "left"),
+        (rps_table["rps120"] + rps_table["rps250"]).to_numpy(),
+        max_gains,
+    )
+    selected_stocks = [
+        {
+            "code": codes[idx],
+            "rps50": round(rps_scalars[codes[idx]]["rps50"], 2),
+            "rps120": round(rps_scalars[codes[idx]]["rps120"], 2),
+            "rps250": round(rps_scalars[codes[idx]]["rps250"], 2),
+            "max_yearly_return": max_gains[idx],
+        }
+        for idx in np.flatnonzero(selected)
+    ]
 
     selected_stocks_df = pd.DataFrame(selected_stocks)
     timestamp = datetime.today().strftime("%y%m%d")
     selected_stocks_df.to_csv(f"rps_first_selected_stocks_{timestamp}.csv", index=False)
 
-    print("\nSelected Stocks:")
-    print(tabulate(selected_stocks_df, headers="keys", tablefmt="grid", numalign="right"))
+    # 终端里显示表格；输出被重定向时直接写制表符分隔的文本，省掉排版开销
+    if sys.stdout.isatty():
+        print("\nSelected Stocks:")
+        print(tabulate(selected_stocks_df, headers="keys", tablefmt="grid", numalign="right"))
+    else:
+        selected_stocks_df.to_csv(sys.stdout, sep="\t", index=False)
 
 if __name__ == "__main__":
     main()
@@ -1,143 +1,122 @@
 #!/usr/bin/env python3
 
+import sys
 import pandas as pd
+import numpy as np
 from datetime import datetime, timedelta
-import os
-import json
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from numba import njit, prange
 from tabulate import tabulate
+from rpscommon import align_to_latest, calculate_rps, date_bounds, load_close_matrix, sma_batch
 
-# 缓存目录
-CACHE_DIR = "stock_cache"
 # 当前年份
 CURRENT_YEAR = datetime.now().year
 YEAR_START_DATE = datetime(CURRENT_YEAR, 1, 1)
 
-def load_cache(bs_code):
-    for prefix in ['sh', 'sz']:
-        cache_file = os.path.join(CACHE_DIR, f"{prefix}.{bs_code}.json")
-        if os.path.exists(cache_file):
-            try:
-                with open(cache_file, "r") as f:
-                    cached_data = json.load(f)
-                df = pd.DataFrame(cached_data)
-                df["date"] = pd.to_datetime(df["date"])
-                df.set_index("date", inplace=True)
-                df['close'] = pd.to_numeric(df['close'], errors='coerce')
-                return df.sort_index()
-            except (json.JSONDecodeError, ValueError):
-                print(f"Error reading cache for {bs_code}.")
-    print(f"No cache file found for {bs_code}")
-    return None
-
-def calculate_moving_averages(df):
-    for window in [10, 20, 200, 250]:
-        df[f"ma{window}"] = df["close"].rolling(window=window).mean()
-    return df
-
-def calculate_rps(all_stocks_data, period):
-    all_closes = pd.DataFrame({code: data['close'] for code, data in all_stocks_data.items()})
-    pct_changes = all_closes.pct_change(periods=period, fill_method=None)
-    ranks = pct_changes.iloc[-1].rank(pct=True)
-    rps = ranks * 100
-    for code in all_stocks_data.keys():
-        all_stocks_data[code][f"rps{period}"] = rps[code]
-    return all_stocks_data
-
-def filter_criteria(df):
-    latest = df.iloc[-1]
-    previous = df.iloc[-2]
-
-    def check_rps():
-        return (latest["rps120"] + latest["rps250"]) > 185
-
-    def check_drawdown():
-        twenty_days_ago = datetime.now() - timedelta(days=20)
-        current_price = latest["close"]
-        max_price = df[df.index > twenty_days_ago]["close"].max()
-        return (max_price - current_price) / max_price <= 0.25
-
-    def check_ma_crossover(days, short_ma, long_ma, threshold):
-        last_n_days = df.iloc[-days:]
-        condition = (last_n_days['close'] > last_n_days[f'ma{short_ma}']) & (last_n_days['close'] > last_n_days[f'ma{long_ma}'])
-        return condition.sum() >= threshold
-
-    def check_price_to_year_high():
-        one_year_ago = datetime.now() - timedelta(days=365)
-        year_high = df[df.index >= one_year_ago]["close"].max()
-        return latest["close"] >= 0.8 * year_high
-
-    def check_ma_trend():
-        last_5_days = df.iloc[-5:]
-        ma_condition_5days = ((last_5_days['ma20'].diff() > 0) & (last_5_days['ma10'] > last_5_days['ma20'])).all()
-        ma_condition_latest = (
-            (latest['ma10'] > previous['ma10']) and
-            (latest['ma20'] > previous['ma20']) and
-            (latest['ma10'] > latest['ma20'])
+def calculate_moving_averages(stock_closes):
+    return {window: sma_batch(stock_closes, window) for window in [10, 20, 200, 250]}
+
+@njit(cache=True, nogil=True)
+def filter_criteria_nb(close, ma10, ma20, ma200, ma250, idx_20d_ago, idx_year_start, idx_year_ago, rps_sum):
+    last = len(close) - 1
+    current_price = close[last]
+
+    # RPS120与RPS250之和大于185
+    if not rps_sum > 185:
+        return False
+
+    # 最近20天最大跌幅不超过25%
+    if idx_20d_ago > last:
+        return False
+    max_price = close[idx_20d_ago:].max()
+    if not (max_price - current_price) / max_price <= 0.25:
+        return False
+
+    # 股价站上均线的天数：最近30行只扫描一遍，同时统计30/10/4日三个窗口
+    above_30d = above_10d = above_4d = 0
+    for i in range(last - 29, last + 1):
+        price = close[i]
+        if price > ma200[i] and price > ma250[i]:
+            above_30d += 1
+        if i > last - 10 and price > ma20[i]:
+            above_10d += 1
+        if i > last - 4 and price > ma10[i] and price > ma20[i]:
+            above_4d += 1
+    if above_30d < 25 or above_10d < 9 or above_4d < 3:
+        return False
+
+    # 股价不低于一年内最高价的80%
+    if idx_year_ago > last or not current_price >= 0.8 * close[idx_year_ago:].max():
+        return False
+
+    # 均线向上：原实现的5日条件在5行切片上做 diff()，首行恒为 NaN，
+    # 因此只有最新一日的条件会生效
+    if not (ma10[last] > ma10[last - 1] and ma20[last] > ma20[last - 1] and ma10[last] > ma20[last]):
+        return False
+
+    # 股价站上20日均线
+    if not current_price > ma20[last]:
+        return False
+
+    # 年初至今涨幅不超过100%，今年没有数据时以去年最后一个收盘价为基准
+    year_start_price = close[idx_year_start] if idx_year_start <= last else close[last]
+    return (current_price - year_start_price) / year_start_price <= 1
+
+@njit(parallel=True, cache=True)
+def filter_all(close, ma10, ma20, ma200, ma250, idx_20d_ago, idx_year_start, idx_year_ago, rps_sum):
+    n_stocks = close.shape[1]
+    selected = np.zeros(n_stocks, dtype=np.bool_)
+    for j in prange(n_stocks):
+        selected[j] = filter_criteria_nb(
+            close[:, j], ma10[:, j], ma20[:, j], ma200[:, j], ma250[:, j],
+            idx_20d_ago[j], idx_year_start[j], idx_year_ago[j], rps_sum[j],
         )
-        return ma_condition_5days or ma_condition_latest
-
-    def check_price_above_ma20():
-        return latest['close'] > latest['ma20']
-
-    def check_ytd_increase():
-        # Try to get data from current year
-        current_year_data = df[df.index >= YEAR_START_DATE]
-        if not current_year_data.empty:
-            year_start_price = current_year_data["close"].iloc[0]
-        else:
-            # If no data for current year, get last price from previous year
-            prev_year_data = df[df.index < YEAR_START_DATE]
-            if prev_year_data.empty:
-                return False  # Not enough data to make a decision
-            year_start_price = prev_year_data["close"].iloc[-1]
-        
-        return (latest["close"] - year_start_price) / year_start_price <= 1
-
-    conditions = [
-        check_rps(),
-        check_drawdown(),
-        check_ma_crossover(30, 200, 250, 25),
-        check_ma_crossover(10, 20, 20, 9),
-        check_ma_crossover(4, 10, 20, 3),
-        check_price_to_year_high(),
-        check_ma_trend(),
-        check_price_above_ma20(),
-        check_ytd_increase()
-    ]
-
-    return all(conditions)
-
-def process_stock(bs_code, all_stocks_data):
-    hist_data = all_stocks_data[bs_code]
-    if len(hist_data) >= 250:
-        hist_data = calculate_moving_averages(hist_data)
-        if filter_criteria(hist_data):
-            latest = hist_data.iloc[-1]
-            return {
-                "code": bs_code,
-                "rps120": round(latest["rps120"], 2),
-                "rps250": round(latest["rps250"], 2),
-            }
-    return None
+    return selected
 
 def main():
-    stock_list = [f.split(".")[1] for f in os.listdir(CACHE_DIR) if f.endswith(".json")]
-    all_stocks_data = {bs_code: load_cache(bs_code) for bs_code in stock_list if load_cache(bs_code) is not None and len(load_cache(bs_code)) >= 250}
-
-    for period in [120, 250]:
-        all_stocks_data = calculate_rps(all_stocks_data, period)
-
-    with ThreadPoolExecutor(max_workers=30) as executor:
-        futures = [executor.submit(process_stock, bs_code, all_stocks_data) for bs_code in all_stocks_data.keys()]
-        selected_stocks = [result for future in as_completed(futures) if (result := future.result()) is not None]
+    codes, dates, close_mat = load_close_matrix()
+    # 上市不足250个交易日的股票不参与排名和筛选；矩阵存储用 float32，计算用 float64
+    eligible = np.count_nonzero(~np.isnan(close_mat), axis=0) >= 250
+    codes = [code for code, is_eligible in zip(codes, eligible) if is_eligible]
+    close_mat = close_mat[:, eligible].astype(np.float64)
+    traded = ~np.isnan(close_mat).all(axis=1)
+    close_mat, dates = close_mat[traded], dates[traded]
+
+    rps_table = pd.DataFrame(
+        {f"rps{period}": calculate_rps(codes, close_mat, period) for period in [120, 250]}
+    )
+    rps_scalars = rps_table.to_dict(orient="index")
+
+    # 所有股票的均线在同一个矩阵上批量计算
+    stock_closes = align_to_latest(close_mat)
+    ma_by_window = calculate_moving_averages(stock_closes)
+
+    now = datetime.now()
+    selected = filter_all(
+        stock_closes, ma_by_window[10], ma_by_window[20], ma_by_window[200], ma_by_window[250],
+        date_bounds(close_mat, dates, now - timedelta(days=20), "right"),
+        date_bounds(close_mat, dates, YEAR_START_DATE, "left"),
+        date_bounds(close_mat, dates, now - timedelta(days=365), "left"),
+        (rps_table["rps120"] + rps_table["rps250"]).to_numpy(),
+    )
+    selected_stocks = [
+        {
+            "code": bs_code,
+            "rps120": round(rps_scalars[bs_code]["rps120"], 2),
+            "rps250": round(rps_scalars[bs_code]["rps250"], 2),
+        }
+        for bs_code, is_selected in zip(codes, selected) if is_selected
+    ]
 
     selected_stocks_df = pd.DataFrame(selected_stocks)
     timestamp = datetime.today().strftime("%y%m%d")
     selected_stocks_df.to_csv(f"train_track_selected_stocks_{timestamp}.csv", index=False)
 
-    print("\nSelected Stocks:")
-    print(tabulate(selected_stocks_df, headers="keys", tablefmt="grid", numalign="right"))
+    # 终端里显示表格；输出被重定向时直接写制表符分隔的文本，省掉排版开销
+    if sys.stdout.isatty():
+        print("\nSelected Stocks:")
+        print(tabulate(selected_stocks_df, headers="keys", tablefmt="grid", numalign="right"))
+    else:
+        selected_stocks_df.to_csv(sys.stdout, sep="\t", index=False)
 
 if __name__ == "__main__":
     main()